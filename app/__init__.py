@@ -1,17 +1,115 @@
 from __future__ import annotations
 
 import os
+import re
 
-from flask import Flask
+import click
+from flask import Flask, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from sqlalchemy import delete, event, func, select
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 login_manager.login_view = "auth.login"
 
 
-def create_app():
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """SQLite 接続ごとに WAL などのパフォーマンス設定を行う"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-64000")  # 約64MB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+    cursor.close()
+
+
+def init_db() -> None:
+    """テーブルとインデックスを作成する（アプリケーションコンテキスト内で呼ぶ）"""
+    db.create_all()
+
+    # ユニークインデックス作成前に、以前のコードで残った重複行を削除
+    _dedupe_unique_rows()
+
+    # 既存テーブルには create_all でインデックスが作られないので個別に作成
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    _import_lesson_asset_files()
+
+
+def _dedupe_unique_rows() -> None:
+    """ix_lp_user_lesson / ix_enr_user_course の対象列で重複している行を削除する"""
+    from .models import Enrollment, LessonProgress
+
+    # 進捗: 完了済み・completed_at が新しい行を1つだけ残す
+    ranked = (
+        select(
+            LessonProgress.id,
+            func.row_number()
+            .over(
+                partition_by=(LessonProgress.user_id, LessonProgress.lesson_id),
+                order_by=(
+                    LessonProgress.is_completed.desc(),
+                    LessonProgress.completed_at.desc().nulls_last(),
+                    LessonProgress.id.desc(),
+                ),
+            )
+            .label("rn"),
+        )
+        .subquery()
+    )
+    db.session.execute(
+        delete(LessonProgress)
+        .where(LessonProgress.id.in_(select(ranked.c.id).where(ranked.c.rn > 1)))
+        .execution_options(synchronize_session=False)
+    )
+
+    # 受講登録: id が最小の行（最初の登録）を残す
+    keep = (
+        select(func.min(Enrollment.id))
+        .group_by(Enrollment.user_id, Enrollment.course_id)
+    )
+    db.session.execute(
+        delete(Enrollment)
+        .where(Enrollment.id.not_in(keep))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def _import_lesson_asset_files() -> None:
+    """lesson_assets テーブル導入前にアップロードされた画像を登録する"""
+    from datetime import datetime
+
+    from .models import Lesson, LessonAsset
+
+    upload_dir = os.path.join(current_app.root_path, "static", "uploads", "lessons")
+    if not os.path.isdir(upload_dir):
+        return
+
+    registered = {name for (name,) in db.session.query(LessonAsset.filename)}
+    lesson_ids = {lesson_id for (lesson_id,) in db.session.query(Lesson.id)}
+    pattern = re.compile(r"lesson(\d+)_")
+
+    with os.scandir(upload_dir) as it:
+        for entry in it:
+            m = pattern.match(entry.name)
+            if not m or entry.name in registered or int(m.group(1)) not in lesson_ids:
+                continue
+            db.session.add(
+                LessonAsset(
+                    lesson_id=int(m.group(1)),
+                    filename=entry.name,
+                    uploaded_at=datetime.utcfromtimestamp(entry.stat().st_mtime),
+                )
+            )
+    db.session.commit()
+
+
+def create_app(test_config: dict | None = None):
     app = Flask(__name__)
 
     # 適当な秘密鍵（本番では環境変数で）
@@ -23,6 +121,26 @@ def create_app():
     app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+    # アップロードサイズの上限（画像アップロード用、8MB）
+    app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024
+
+    # コネクションプール設定
+    # - pool_pre_ping: 切れた接続を使う前に検知して張り直す
+    # - pool_recycle: 長時間使い回した接続を定期的に作り直す（秒）
+    # - check_same_thread: スレッド付きサーバーで SQLite 接続をプール共有するため
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+        "connect_args": {"check_same_thread": False},
+    }
+
+    # 起動時に DB 作成を行うか（通常はデプロイ時に `flask --app run init-db` を1回実行）
+    app.config["AUTO_INIT_DB"] = os.environ.get("AUTO_INIT_DB") == "1"
+
+    # テスト等からの設定上書き（例: {"SQLALCHEMY_ENGINE_OPTIONS": {"poolclass": StaticPool}}）
+    if test_config:
+        app.config.update(test_config)
+
     db.init_app(app)
     login_manager.init_app(app)
 
@@ -36,8 +154,20 @@ def create_app():
     app.register_blueprint(auth_bp)
     app.register_blueprint(main_bp)
 
-    # DB作成
+    # DB作成コマンド: flask --app run init-db
+    @app.cli.command("init-db")
+    def init_db_command():
+        """テーブルとインデックスを作成する"""
+        init_db()
+        click.echo("データベースを初期化しました。")
+
     with app.app_context():
-        db.create_all()
+        # SQLite のときだけ接続時 PRAGMA を設定
+        if db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
+        # ワーカー起動ごとのスキーマ確認を避けるため、明示したときだけ DB作成
+        if app.config["AUTO_INIT_DB"]:
+            init_db()
 
     return app
@@ -21,7 +21,12 @@ def register():
             flash("すべて入力してください。", "danger")
             return redirect(url_for("auth.register"))
 
-        if User.query.filter((User.username == username) | (User.email == email)).first():
+        already_used = db.session.query(
+            User.query.filter(
+                (User.username == username) | (User.email == email)
+            ).exists()
+        ).scalar()
+        if already_used:
             flash("そのユーザー名またはメールアドレスは既に使われています。", "danger")
             return redirect(url_for("auth.register"))
 
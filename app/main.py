@@ -1,10 +1,16 @@
 from __future__ import annotations
-from sqlalchemy import or_
+from sqlalchemy import and_, case, func, insert, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import defer, joinedload, raiseload, selectinload, undefer
 from flask import abort
-from datetime import datetime, date, timedelta
+from collections import Counter
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from time import monotonic
 
 import os
 import re
+import shutil
 
 from flask import (
     Blueprint,
@@ -16,13 +22,14 @@ from flask import (
     current_app,
 )
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
 from markupsafe import Markup, escape
 
 from . import db
 from .models import (
+    User,
     Course,
     Lesson,
+    LessonAsset,
     Enrollment,
     LessonProgress,
     QuizQuestion,
@@ -45,32 +52,50 @@ def _build_progress_map(courses, user):
     if not getattr(user, "is_authenticated", False):
         return progress_map
 
-    for course in courses:
-        total_lessons = Lesson.query.filter_by(course_id=course.id).count()
-        if total_lessons == 0:
-            progress_map[course.id] = {
-                "completed": 0,
-                "total": 0,
-                "percent": 0,
-                "is_completed": False,
-            }
-            continue
+    course_ids = [course.id for course in courses]
+    if not course_ids:
+        return progress_map
 
-        completed_count = (
-            LessonProgress.query
+    # コースごとのレッスン数（1クエリでまとめて集計）
+    total_by_course = dict(
+        db.session.query(Lesson.course_id, func.count(Lesson.id))
+        .filter(Lesson.course_id.in_(course_ids))
+        .group_by(Lesson.course_id)
+        .all()
+    )
+
+    # コースごとの完了レッスン数（1クエリでまとめて集計）
+    # 受講登録が1件もなければ完了数はすべて 0 なので集計クエリ自体を省略
+    completed_by_course: dict[int, int] = {}
+    if _has_enrollments(user):
+        completed_by_course = dict(
+            db.session.query(Lesson.course_id, func.count(LessonProgress.id))
             .join(Lesson, LessonProgress.lesson_id == Lesson.id)
             .filter(
-                Lesson.course_id == course.id,
+                Lesson.course_id.in_(course_ids),
                 LessonProgress.user_id == user.id,
                 LessonProgress.is_completed.is_(True),
             )
-            .count()
+            .group_by(Lesson.course_id)
+            .all()
         )
 
+    for course_id in course_ids:
+        total_lessons = total_by_course.get(course_id, 0)
+        if total_lessons == 0:
+            progress_map[course_id] = {
+                "completed": 0,
+                "total": 0,
+                "percent": 0,
+                "is_completed": False,
+            }
+            continue
+
+        completed_count = completed_by_course.get(course_id, 0)
         percent = int(completed_count / total_lessons * 100)
         is_completed = (completed_count == total_lessons)
 
-        progress_map[course.id] = {
+        progress_map[course_id] = {
             "completed": completed_count,
             "total": total_lessons,
             "percent": percent,
@@ -80,10 +105,58 @@ def _build_progress_map(courses, user):
     return progress_map
 
 
+def _has_enrollments(user) -> bool:
+    """受講登録が1件でもあるか（EXISTS で確認）"""
+    return db.session.query(
+        Enrollment.query.filter_by(user_id=user.id).exists()
+    ).scalar()
+
+
+def _is_enrolled(user, course_id: int) -> bool:
+    """指定コースに受講登録しているか（EXISTS で確認）"""
+    return db.session.query(
+        Enrollment.query.filter_by(user_id=user.id, course_id=course_id).exists()
+    ).scalar()
+
+
+# -------------------------
+# 画像アップロード共通処理
+# -------------------------
+# 先頭バイト（マジックナンバー）→ 保存時の拡張子
+_IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": ".png",
+    b"\xff\xd8\xff": ".jpg",
+    b"GIF87a": ".gif",
+    b"GIF89a": ".gif",
+}
+
+_UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
+
+
+def _sniff_image_ext(file) -> str | None:
+    """ファイル名ではなく先頭バイトから画像形式を判定し、拡張子を返す"""
+    header = file.stream.read(12)
+    file.stream.seek(0)
+    for signature, ext in _IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return ext
+    return None
+
+
+def _save_upload(file, file_path: str) -> None:
+    """アップロードファイルを 1MB ずつディスクへ書き出す"""
+    with open(file_path, "wb") as dst:
+        shutil.copyfileobj(file.stream, dst, length=_UPLOAD_CHUNK_SIZE)
+
+
 # -------------------------
 # レッスン本文リッチ表示フィルタ
 # [[image:ファイル名]], [[youtube:URL]] を変換
 # -------------------------
+_RICH_PATTERN = re.compile(r"\[\[(image|youtube):([^\]]+)\]\]")
+_YOUTUBE_ID_RE = re.compile(r"(?:watch\?v=|youtu\.be/)([A-Za-z0-9_-]+)")
+
+
 @bp.app_template_filter("rich_lesson")
 def rich_lesson(text: str | None) -> Markup:
     """
@@ -96,19 +169,16 @@ def rich_lesson(text: str | None) -> Markup:
     if not text:
         return Markup("")
 
-    pattern = re.compile(r"\[\[(image|youtube):([^\]]+)\]\]")
-    result_parts: list[str | Markup] = []
+    result_parts: list[str] = []
     last = 0
 
     s = text
 
-    from flask import url_for  # フィルタ内で使う
-
-    for m in pattern.finditer(s):
-        # 通常テキスト部分
+    for m in _RICH_PATTERN.finditer(s):
+        # 通常テキスト部分（エスケープ後、改行だけ <br> に変換）
         before = s[last : m.start()]
         if before:
-            result_parts.append(escape(before))
+            result_parts.append(str(escape(before)).replace("\n", "<br>\n"))
 
         kind = m.group(1)
         value = m.group(2).strip()
@@ -120,19 +190,14 @@ def rich_lesson(text: str | None) -> Markup:
                 f'<img src="{src}" alt="{escape(value)}" '
                 f'style="max-width:100%;height:auto;margin:0.5rem 0;">'
             )
-            result_parts.append(Markup(html))
+            result_parts.append(html)
 
         elif kind == "youtube":
             url = value
-            video_id = None
+            id_match = _YOUTUBE_ID_RE.search(url)
 
-            if "watch?v=" in url:
-                video_id = url.split("watch?v=")[-1].split("&")[0]
-            elif "youtu.be/" in url:
-                video_id = url.split("youtu.be/")[-1].split("?")[0]
-
-            if video_id:
-                embed_src = f"https://www.youtube.com/embed/{video_id}"
+            if id_match:
+                embed_src = f"https://www.youtube.com/embed/{id_match.group(1)}"
             else:
                 embed_src = url  # うまく取れなかった場合はそのまま
 
@@ -145,19 +210,53 @@ def rich_lesson(text: str | None) -> Markup:
   ></iframe>
 </div>
 """
-            result_parts.append(Markup(iframe))
+            result_parts.append(iframe)
 
         last = m.end()
 
     # 最後の残りテキスト
     tail = s[last:]
     if tail:
-        result_parts.append(escape(tail))
+        result_parts.append(str(escape(tail)).replace("\n", "<br>\n"))
 
-    html_all = "".join(str(p) for p in result_parts)
-    # 改行は <br> に変換
-    html_all = html_all.replace("\n", "<br>\n")
-    return Markup(html_all)
+    return Markup("".join(result_parts))
+
+
+# -------------------------
+# 絞り込み用カテゴリ / レベル（キャッシュ付き）
+# -------------------------
+_FILTER_CACHE_TTL = 60  # 秒
+
+
+def _filter_cache_bucket() -> int:
+    """キャッシュキー用の時間バケット（TTL ごとに切り替わる）"""
+    return int(monotonic() // _FILTER_CACHE_TTL)
+
+
+@lru_cache(maxsize=1)
+def _get_categories(bucket: int) -> tuple[str, ...]:
+    """存在するカテゴリを Distinct で取得（bucket が変わるまでキャッシュ）"""
+    return tuple(
+        row[0]
+        for row in db.session.query(Course.category)
+        .distinct()
+        .order_by(Course.category.asc())
+        .all()
+        if row[0]
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_levels(bucket: int) -> tuple[str, ...]:
+    """存在するレベルを Distinct で取得（bucket が変わるまでキャッシュ）"""
+    return tuple(
+        row[0]
+        for row in db.session.query(Course.level)
+        .distinct()
+        .order_by(Course.level.asc())
+        .all()
+        if row[0]
+    )
 
 
 # ===========================
@@ -193,23 +292,10 @@ def index():
 
     courses = query.all()
 
-    # セレクトボックス用に、存在するカテゴリ＆レベルをDistinctで取得
-    all_categories = [
-        row[0]
-        for row in db.session.query(Course.category)
-        .distinct()
-        .order_by(Course.category.asc())
-        .all()
-        if row[0]
-    ]
-    all_levels = [
-        row[0]
-        for row in db.session.query(Course.level)
-        .distinct()
-        .order_by(Course.level.asc())
-        .all()
-        if row[0]
-    ]
+    # セレクトボックス用のカテゴリ＆レベル（短時間キャッシュ）
+    bucket = _filter_cache_bucket()
+    all_categories = _get_categories(bucket)
+    all_levels = _get_levels(bucket)
 
     # 進捗マップ
     progress_map = {}
@@ -243,6 +329,7 @@ def course_list():
         )
 
     courses = query.order_by(Course.created_at.desc()).all()
+
     progress_map = _build_progress_map(courses, current_user)
 
     return render_template(
@@ -259,11 +346,7 @@ def course_certificate(course_id: int):
     course = Course.query.get_or_404(course_id)
 
     # 受講しているかチェック
-    enrollment = Enrollment.query.filter_by(
-        user_id=current_user.id,
-        course_id=course.id,
-    ).first()
-    if not enrollment:
+    if not _is_enrolled(current_user, course.id):
         flash("このコースを受講していません。", "warning")
         return redirect(url_for("main.course_detail", course_id=course.id))
 
@@ -275,24 +358,23 @@ def course_certificate(course_id: int):
 
     lesson_ids = [l.id for l in lessons]
 
-    # 完了したレッスン数
-    q = (
-        LessonProgress.query
+    # 完了したレッスン数と、修了日＝最後に完了したレッスンの日時を1クエリで取得
+    completed_count, completed_at = (
+        db.session.query(
+            func.count(LessonProgress.id),
+            func.max(LessonProgress.completed_at),
+        )
         .filter(LessonProgress.user_id == current_user.id)
         .filter(LessonProgress.lesson_id.in_(lesson_ids))
         .filter(LessonProgress.is_completed == True)
+        .one()
     )
-    completed_count = q.count()
     total_count = len(lesson_ids)
 
     if completed_count < total_count:
         flash("このコースはまだ修了していません。", "warning")
         return redirect(url_for("main.course_detail", course_id=course.id))
 
-    # 修了日＝最後に完了したレッスンの日付
-    latest_progress = q.order_by(LessonProgress.completed_at.desc()).first()
-    completed_at = latest_progress.completed_at if latest_progress else None
-
     return render_template(
         "courses/certificate.html",
         course=course,
@@ -303,18 +385,17 @@ def course_certificate(course_id: int):
 @login_required
 def dashboard():
     # 受講中コース
-    enrollments = Enrollment.query.filter_by(user_id=current_user.id).all()
-    course_ids = [e.course_id for e in enrollments]
-    courses = Course.query.filter(Course.id.in_(course_ids)).all() if course_ids else []
+    enrollments = (
+        Enrollment.query
+        .options(joinedload(Enrollment.course))
+        .filter_by(user_id=current_user.id)
+        .all()
+    )
+    courses = [e.course for e in enrollments]
 
     progress_map = _build_progress_map(courses, current_user)
 
     total_courses = len(courses)
-    total_lessons_completed = LessonProgress.query.filter_by(
-        user_id=current_user.id,
-        is_completed=True,
-    ).count()
-    total_quizzes = QuizResult.query.filter_by(user_id=current_user.id).count()
 
     # 完了コース数
     completed_courses = 0
@@ -348,92 +429,76 @@ def dashboard():
 
     # ====== 今日・今週・平均スコア ======
     today = datetime.utcnow().date()
-    start_of_today = datetime(today.year, today.month, today.day)
+    start_of_today = datetime.combine(today, time.min)
 
     weekday = today.weekday()  # 0: 月, 6: 日
-    start_of_week_date = today - timedelta(days=weekday)
-    start_of_week = datetime(
-        start_of_week_date.year,
-        start_of_week_date.month,
-        start_of_week_date.day,
-    )
-
-    # 今日完了したレッスン
-    today_completed_lessons = (
-        LessonProgress.query
-        .filter_by(user_id=current_user.id, is_completed=True)
-        .filter(LessonProgress.completed_at >= start_of_today)
-        .count()
+    start_of_week = datetime.combine(today - timedelta(days=weekday), time.min)
+
+    # 完了レッスン数（全期間・今日・今週）を1クエリでまとめて集計
+    (
+        total_lessons_completed,
+        today_completed_lessons,
+        week_completed_lessons,
+    ) = (
+        db.session.query(
+            func.count(LessonProgress.id),
+            func.count(
+                case((LessonProgress.completed_at >= start_of_today, LessonProgress.id))
+            ),
+            func.count(
+                case((LessonProgress.completed_at >= start_of_week, LessonProgress.id))
+            ),
+        )
+        .filter(
+            LessonProgress.user_id == current_user.id,
+            LessonProgress.is_completed.is_(True),
+        )
+        .one()
     )
 
-    # 今週完了したレッスン
-    week_completed_lessons = (
-        LessonProgress.query
-        .filter_by(user_id=current_user.id, is_completed=True)
-        .filter(LessonProgress.completed_at >= start_of_week)
-        .count()
+    # クイズ受験回数 & 平均スコア（％）は SQL 側で集計
+    total_correct, total_questions, total_quizzes = (
+        db.session.query(
+            func.coalesce(func.sum(QuizResult.score), 0),
+            func.coalesce(func.sum(QuizResult.total_questions), 0),
+            func.count(QuizResult.id),
+        )
+        .filter(QuizResult.user_id == current_user.id)
+        .one()
     )
-
-    # クイズ平均スコア（％）
-    all_quiz_results = QuizResult.query.filter_by(user_id=current_user.id).all()
-    total_correct = sum(r.score for r in all_quiz_results)
-    total_questions = sum(r.total_questions for r in all_quiz_results)
     avg_quiz_score = 0
     if total_questions > 0:
         avg_quiz_score = int(total_correct / total_questions * 100)
 
-    # ====== 直近7日間の「日ごとの完了レッスン数」 ======
-    start_chart_date = today - timedelta(days=6)
-    start_chart = datetime(
-        start_chart_date.year,
-        start_chart_date.month,
-        start_chart_date.day,
-    )
+    # ====== 直近60日間の「日ごとの完了レッスン数」（グラフ・ストリーク共通） ======
+    streak_start = datetime.combine(today - timedelta(days=59), time.min)
 
-    recent_progress = (
-        LessonProgress.query
-        .filter_by(user_id=current_user.id, is_completed=True)
-        .filter(LessonProgress.completed_at >= start_chart)
+    # 日付単位の集計は SQL 側で行い、最大60行（日付, 件数）だけ受け取る
+    completed_day = func.date(LessonProgress.completed_at)
+    daily_rows = (
+        db.session.query(completed_day, func.count(LessonProgress.id))
+        .filter(
+            LessonProgress.user_id == current_user.id,
+            LessonProgress.is_completed.is_(True),
+            LessonProgress.completed_at >= streak_start,
+        )
+        .group_by(completed_day)
         .all()
     )
 
-    counts_by_date: dict[date, int] = {}
-    for p in recent_progress:
-        if not p.completed_at:
-            continue
-        d = p.completed_at.date()
-        if d < start_chart_date or d > today:
-            continue
-        counts_by_date[d] = counts_by_date.get(d, 0) + 1
-
-    # グラフ用ラベルと値（古い日→新しい日）
-    chart_labels: list[str] = []
-    chart_values: list[int] = []
-    for i in range(6, -1, -1):
-        d = today - timedelta(days=i)
-        chart_labels.append(d.strftime("%m/%d"))
-        chart_values.append(counts_by_date.get(d, 0))
-
-    # ====== 連続学習日数（ストリーク） ======
-    streak_start_date = today - timedelta(days=59)
-    streak_start = datetime(
-        streak_start_date.year,
-        streak_start_date.month,
-        streak_start_date.day,
+    # SQLite の date() は "YYYY-MM-DD" 文字列を返すので date に変換
+    # （Counter なので記録のない日は 0 になる）
+    counts_by_date: Counter[date] = Counter(
+        {date.fromisoformat(str(day)): count for day, count in daily_rows}
     )
 
-    streak_progress = (
-        LessonProgress.query
-        .filter_by(user_id=current_user.id, is_completed=True)
-        .filter(LessonProgress.completed_at >= streak_start)
-        .all()
-    )
+    # ====== 直近7日間のグラフ用ラベルと値（古い日→新しい日） ======
+    chart_days = [today - timedelta(days=i) for i in range(6, -1, -1)]
+    chart_labels = [d.strftime("%m/%d") for d in chart_days]
+    chart_values = [counts_by_date[d] for d in chart_days]
 
-    learned_dates = {
-        p.completed_at.date()
-        for p in streak_progress
-        if p.completed_at is not None
-    }
+    # ====== 連続学習日数（ストリーク） ======
+    learned_dates = set(counts_by_date)
 
     # 現在のストリーク
     current_streak_days = 0
@@ -506,7 +571,12 @@ def history():
     end_date_str = request.args.get("end_date") or ""
 
     # 自分が受講しているコース（セレクトボックス用）
-    enrollments = Enrollment.query.filter_by(user_id=current_user.id).all()
+    enrollments = (
+        Enrollment.query
+        .options(joinedload(Enrollment.course))
+        .filter_by(user_id=current_user.id)
+        .all()
+    )
     courses = [e.course for e in enrollments]
 
     # 共通の日時条件を作成
@@ -517,12 +587,11 @@ def history():
     try:
         if start_date_str:
             d = datetime.strptime(start_date_str, "%Y-%m-%d").date()
-            start_dt = datetime(d.year, d.month, d.day)
+            start_dt = datetime.combine(d, time.min)
         if end_date_str:
             d = datetime.strptime(end_date_str, "%Y-%m-%d").date()
             # 終了日はその日の終わりまで含めたいので +1日した0時を「<」で判定
-            d_next = d + timedelta(days=1)
-            end_dt = datetime(d_next.year, d_next.month, d_next.day)
+            end_dt = datetime.combine(d + timedelta(days=1), time.min)
     except ValueError:
         # 日付フォーマットがおかしいときは無視して全期間扱い
         start_dt = None
@@ -591,48 +660,82 @@ def history():
 def quiz_summary():
     """自分のクイズ成績をレッスンごとに集計して表示"""
 
-    # 自分の全クイズ結果（レッスン付き）
-    results = (
-        QuizResult.query
-        .filter_by(user_id=current_user.id)
-        .join(Lesson)
-        .join(Course)
-        .order_by(QuizResult.taken_at.desc())
+    # lesson_id ごとに
+    #   - 受験回数
+    #   - 最新の結果（taken_at が最大）
+    #   - ベストの結果（score が最大、同点なら新しい方）
+    # を SQL のウィンドウ関数で求め、最新 / ベストの行だけを取得する
+    ranked = (
+        db.session.query(
+            QuizResult.id.label("id"),
+            func.count(QuizResult.id)
+            .over(partition_by=QuizResult.lesson_id)
+            .label("attempts"),
+            func.row_number()
+            .over(
+                partition_by=QuizResult.lesson_id,
+                order_by=(QuizResult.taken_at.desc(), QuizResult.id.desc()),
+            )
+            .label("latest_rank"),
+            func.row_number()
+            .over(
+                partition_by=QuizResult.lesson_id,
+                order_by=(
+                    QuizResult.score.desc(),
+                    QuizResult.taken_at.desc(),
+                    QuizResult.id.desc(),
+                ),
+            )
+            .label("best_rank"),
+        )
+        .filter(QuizResult.user_id == current_user.id)
+        .subquery()
+    )
+
+    rows = (
+        db.session.query(
+            QuizResult,
+            ranked.c.attempts,
+            ranked.c.latest_rank,
+            ranked.c.best_rank,
+        )
+        .join(ranked, ranked.c.id == QuizResult.id)
+        .options(joinedload(QuizResult.lesson).joinedload(Lesson.course))
+        .filter(or_(ranked.c.latest_rank == 1, ranked.c.best_rank == 1))
+        # 同じコース・同じ並び順のレッスンは、以前と同じく受験が新しい順に並べる
+        .order_by(QuizResult.taken_at.desc(), QuizResult.id.desc())
         .all()
     )
 
-    # lesson_id ごとに集計
     summary_by_lesson: dict[int, dict] = {}
 
-    for r in results:
-        lid = r.lesson_id
-        if lid not in summary_by_lesson:
-            summary_by_lesson[lid] = {
+    for r, attempts, latest_rank, best_rank in rows:
+        entry = summary_by_lesson.setdefault(
+            r.lesson_id,
+            {
                 "lesson": r.lesson,
                 "course": r.lesson.course,
-                "attempts": 0,
+                "attempts": attempts,
                 "best_score": 0,
                 "best_percent": 0,
                 "total_questions": r.total_questions,
                 "last_taken_at": None,
-                "latest_result": r,  # 最新の結果（順序的に最初に来るのが最新）
-            }
+                "latest_result": None,
+            },
+        )
 
-        entry = summary_by_lesson[lid]
-        entry["attempts"] += 1
+        # 最新の結果
+        if latest_rank == 1:
+            entry["last_taken_at"] = r.taken_at
+            entry["latest_result"] = r
 
-        # ベストスコア更新
-        if r.score > entry["best_score"]:
+        # ベストスコア
+        if best_rank == 1:
             entry["best_score"] = r.score
             entry["total_questions"] = r.total_questions
             if r.total_questions > 0:
                 entry["best_percent"] = int(r.score / r.total_questions * 100)
 
-        # 最終受験日時（結果は taken_at desc で並べてあるので、最初が最新だが一応チェック）
-        if entry["last_taken_at"] is None or r.taken_at > entry["last_taken_at"]:
-            entry["last_taken_at"] = r.taken_at
-            entry["latest_result"] = r
-
     # 表示用にリストへ（コース / レッスン名でソート）
     summary_list = sorted(
         summary_by_lesson.values(),
@@ -680,10 +783,8 @@ def profile():
         # アイコン画像アップロード
         file = request.files.get("avatar")
         if file and file.filename:
-            filename = secure_filename(file.filename)
-            _, ext = os.path.splitext(filename)
-            ext = ext.lower()
-            if ext not in {".png", ".jpg", ".jpeg", ".gif"}:
+            ext = _sniff_image_ext(file)
+            if ext is None:
                 flash(
                     "画像ファイル（png / jpg / jpeg / gif）だけアップロードできます。",
                     "danger",
@@ -696,7 +797,7 @@ def profile():
 
                 new_name = f"user{current_user.id}{ext}"
                 file_path = os.path.join(upload_dir, new_name)
-                file.save(file_path)
+                _save_upload(file, file_path)
 
                 profile.avatar_filename = new_name
 
@@ -726,15 +827,16 @@ def create_course():
             flash("タイトルは必須です。", "danger")
             return redirect(url_for("main.create_course"))
 
+        # サムネ画像のファイル名と created_at を同じ時刻にそろえる
+        now = datetime.utcnow()
+
         # サムネ画像
         thumbnail_file = request.files.get("thumbnail")
         thumbnail_filename = None
 
         if thumbnail_file and thumbnail_file.filename:
-            filename = secure_filename(thumbnail_file.filename)
-            _, ext = os.path.splitext(filename)
-            ext = ext.lower()
-            if ext not in {".png", ".jpg", ".jpeg", ".gif"}:
+            ext = _sniff_image_ext(thumbnail_file)
+            if ext is None:
                 flash(
                     "サムネ画像は png / jpg / jpeg / gif のみアップロードできます。",
                     "danger",
@@ -746,10 +848,10 @@ def create_course():
             )
             os.makedirs(upload_dir, exist_ok=True)
 
-            ts = int(datetime.utcnow().timestamp())
+            ts = int(now.timestamp())
             thumbnail_filename = f"course_{ts}{ext}"
             file_path = os.path.join(upload_dir, thumbnail_filename)
-            thumbnail_file.save(file_path)
+            _save_upload(thumbnail_file, file_path)
 
         course = Course(
             title=title,
@@ -757,10 +859,15 @@ def create_course():
             thumbnail_filename=thumbnail_filename,
             category=category,
             level=level,
+            created_at=now,
         )
         db.session.add(course)
         db.session.commit()
 
+        # 絞り込み用のカテゴリ / レベルが変わるのでキャッシュを破棄
+        _get_categories.cache_clear()
+        _get_levels.cache_clear()
+
         flash("コースを作成しました。", "success")
         return redirect(url_for("main.course_detail", course_id=course.id))
 
@@ -775,7 +882,7 @@ def create_course():
 @login_required
 def course_detail(course_id: int):
     course = Course.query.get_or_404(course_id)
-    lessons = Lesson.query.filter_by(course_id=course.id).order_by(Lesson.sort_order).all()
+    lessons = course.lessons
 
     enrollment = Enrollment.query.filter_by(
         user_id=current_user.id, course_id=course.id
@@ -783,9 +890,16 @@ def course_detail(course_id: int):
 
     progress_map: dict[int, bool] = {}
     if enrollment:
-        progresses = LessonProgress.query.filter_by(user_id=current_user.id).all()
-        for p in progresses:
-            progress_map[p.lesson_id] = p.is_completed
+        # このコースのレッスン分だけ（ORM オブジェクトにせずタプルで）取得
+        progress_map = dict(
+            db.session.query(LessonProgress.lesson_id, LessonProgress.is_completed)
+            .join(Lesson, LessonProgress.lesson_id == Lesson.id)
+            .filter(
+                Lesson.course_id == course.id,
+                LessonProgress.user_id == current_user.id,
+            )
+            .all()
+        )
 
     # コース完了判定（全レッスン完了）
     course_completed = False
@@ -810,7 +924,7 @@ def course_detail(course_id: int):
 def enroll_course(course_id: int):
     course = Course.query.get_or_404(course_id)
 
-    if Enrollment.query.filter_by(user_id=current_user.id, course_id=course.id).first():
+    if _is_enrolled(current_user, course.id):
         flash("すでに受講登録済みです。", "info")
         return redirect(url_for("main.course_detail", course_id=course.id))
 
@@ -864,22 +978,37 @@ def create_lesson(course_id: int):
 @bp.route("/lessons/<int:lesson_id>")
 @login_required
 def lesson_detail(lesson_id: int):
-    lesson = Lesson.query.get_or_404(lesson_id)
+    lesson = Lesson.query.options(undefer(Lesson.content)).get_or_404(lesson_id)
     course = lesson.course
 
     if current_user.role != "admin":
-        enrollment = Enrollment.query.filter_by(
-            user_id=current_user.id, course_id=course.id
-        ).first()
-        if not enrollment:
+        # 受講登録チェックと進捗の取得を1クエリで（進捗がなければ NULL）
+        row = (
+            db.session.query(Enrollment.id, LessonProgress.is_completed)
+            .outerjoin(
+                LessonProgress,
+                and_(
+                    LessonProgress.user_id == current_user.id,
+                    LessonProgress.lesson_id == lesson.id,
+                ),
+            )
+            .filter(
+                Enrollment.user_id == current_user.id,
+                Enrollment.course_id == course.id,
+            )
+            .first()
+        )
+        if row is None:
             flash("このコースを受講登録していません。", "danger")
             return redirect(url_for("main.course_detail", course_id=course.id))
-
-    progress = LessonProgress.query.filter_by(
-        user_id=current_user.id,
-        lesson_id=lesson.id,
-    ).first()
-    is_completed = bool(progress and progress.is_completed)
+        is_completed = bool(row.is_completed)
+    else:
+        progress = (
+            db.session.query(LessonProgress.is_completed)
+            .filter_by(user_id=current_user.id, lesson_id=lesson.id)
+            .first()
+        )
+        is_completed = bool(progress and progress.is_completed)
 
     next_lesson = (
         Lesson.query.filter(
@@ -890,9 +1019,15 @@ def lesson_detail(lesson_id: int):
         .first()
     )
 
-    quiz_count = QuizQuestion.query.filter_by(lesson_id=lesson.id).count()
+    quiz_count = (
+        db.session.query(func.count(QuizQuestion.id))
+        .filter_by(lesson_id=lesson.id)
+        .scalar()
+    )
+
+    # クイズがあるときだけ最新結果を取得（テンプレートでもクイズがある場合のみ表示）
     latest_result = None
-    if current_user.is_authenticated:
+    if quiz_count > 0:
         latest_result = (
             QuizResult.query.filter_by(user_id=current_user.id, lesson_id=lesson.id)
             .order_by(QuizResult.taken_at.desc())
@@ -931,30 +1066,46 @@ def lesson_assets(lesson_id: int):
             flash("ファイルを選択してください。", "danger")
             return redirect(url_for("main.lesson_assets", lesson_id=lesson.id))
 
-        filename = secure_filename(file.filename)
-        _, ext = os.path.splitext(filename)
-        ext = ext.lower()
-        if ext not in {".png", ".jpg", ".jpeg", ".gif"}:
+        # 拡張子ではなく先頭バイトで判定（保存名の拡張子もここで決まる）
+        ext = _sniff_image_ext(file)
+        if ext is None:
             flash(
                 "画像ファイル（png / jpg / jpeg / gif）のみアップロードできます。",
                 "danger",
             )
             return redirect(url_for("main.lesson_assets", lesson_id=lesson.id))
 
-        ts = int(datetime.utcnow().timestamp())
+        now = datetime.utcnow()
+        ts = int(now.timestamp())
         new_name = f"lesson{lesson.id}_{ts}{ext}"
         file_path = os.path.join(upload_dir, new_name)
-        file.save(file_path)
+        _save_upload(file, file_path)
+
+        # 同じ秒に同名で上書きされた場合は既存行の日時だけ更新
+        stmt = (
+            sqlite_insert(LessonAsset)
+            .values(lesson_id=lesson.id, filename=new_name, uploaded_at=now)
+            .on_conflict_do_update(
+                index_elements=["filename"],
+                set_={"uploaded_at": now},
+            )
+        )
+        db.session.execute(stmt)
+        db.session.commit()
 
         flash(f"画像をアップロードしました。本文では [[image:{new_name}]] と書いて使えます。", "success")
         return redirect(url_for("main.lesson_assets", lesson_id=lesson.id))
 
-    # このレッスン用の画像一覧（ファイル名が lesson{lesson.id}_ で始まるもの）
-    files: list[str] = []
-    if os.path.isdir(upload_dir):
-        for fname in sorted(os.listdir(upload_dir)):
-            if fname.startswith(f"lesson{lesson.id}_"):
-                files.append(fname)
+    # このレッスン用の画像一覧（新しい順、ディレクトリは走査せず DB から引く）
+    files = [
+        filename
+        for (filename,) in (
+            db.session.query(LessonAsset.filename)
+            .filter(LessonAsset.lesson_id == lesson.id)
+            .order_by(LessonAsset.uploaded_at.desc(), LessonAsset.id.desc())
+            .all()
+        )
+    ]
 
     return render_template("courses/lesson_assets.html", lesson=lesson, files=files)
 
@@ -966,30 +1117,26 @@ def lesson_assets(lesson_id: int):
 @login_required
 def complete_lesson(lesson_id: int):
     lesson = Lesson.query.get_or_404(lesson_id)
-    enrollment = Enrollment.query.filter_by(
-        user_id=current_user.id, course_id=lesson.course_id
-    ).first()
-    if not enrollment:
+    if not _is_enrolled(current_user, lesson.course_id):
         flash("このコースを受講登録していません。", "danger")
         return redirect(url_for("main.course_detail", course_id=lesson.course_id))
 
-    progress = LessonProgress.query.filter_by(
-        user_id=current_user.id,
-        lesson_id=lesson.id,
-    ).first()
-
-    if not progress:
-        progress = LessonProgress(
+    # 進捗行がなければ作成、あれば完了に更新（INSERT ... ON CONFLICT DO UPDATE の1文で）
+    now = datetime.utcnow()
+    stmt = (
+        sqlite_insert(LessonProgress)
+        .values(
             user_id=current_user.id,
             lesson_id=lesson.id,
             is_completed=True,
-            completed_at=datetime.utcnow(),
+            completed_at=now,
         )
-        db.session.add(progress)
-    else:
-        progress.is_completed = True
-        progress.completed_at = datetime.utcnow()
-
+        .on_conflict_do_update(
+            index_elements=["user_id", "lesson_id"],
+            set_={"is_completed": True, "completed_at": now},
+        )
+    )
+    db.session.execute(stmt)
     db.session.commit()
     flash("レッスンを完了にしました。", "success")
     return redirect(url_for("main.lesson_detail", lesson_id=lesson.id))
@@ -1101,6 +1248,14 @@ def quiz_edit(question_id: int):
     question = QuizQuestion.query.get_or_404(question_id)
     lesson = question.lesson
 
+    # 既存の選択肢（id 順 = フォームの選択肢1〜4の並び）
+    choices = (
+        QuizChoice.query
+        .filter_by(question_id=question.id)
+        .order_by(QuizChoice.id.asc())
+        .all()
+    )
+
     if request.method == "POST":
         # フォームから値を取得
         question_text = request.form.get("question_text", "").strip()
@@ -1163,31 +1318,31 @@ def quiz_edit(question_id: int):
         question.explanation = explanation
         question.sort_order = sort_order
 
-        # 既存の選択肢を一旦削除して作り直す（シンプル実装）
-        QuizChoice.query.filter_by(question_id=question.id).delete()
-
+        # 既存の選択肢と位置ごとに突き合わせて差分だけ更新する
+        # （選択肢の id を保つので、過去の解答 QuizResultDetail の参照が切れない）
         for i, text in enumerate(choices_text, start=1):
-            if not text:
-                continue
-            choice = QuizChoice(
-                question_id=question.id,
-                choice_text=text,
-                is_correct=(i == correct_index),
-            )
-            db.session.add(choice)
+            existing = choices[i - 1] if i <= len(choices) else None
+            if existing and text:
+                existing.choice_text = text
+                existing.is_correct = (i == correct_index)
+            elif existing:
+                db.session.delete(existing)
+            elif text:
+                db.session.add(QuizChoice(
+                    question_id=question.id,
+                    choice_text=text,
+                    is_correct=(i == correct_index),
+                ))
+
+        # フォームの4枠を超える古い選択肢は削除
+        for extra in choices[len(choices_text):]:
+            db.session.delete(extra)
 
         db.session.commit()
         flash("クイズ問題を更新しました。", "success")
         return redirect(url_for("main.quiz_manage", lesson_id=lesson.id))
 
     # GET: 既存データをフォームに反映
-    choices = (
-        QuizChoice.query
-        .filter_by(question_id=question.id)
-        .order_by(QuizChoice.id.asc())
-        .all()
-    )
-
     choice_texts = ["", "", "", ""]
     correct_index = 1
 
@@ -1236,19 +1391,21 @@ def quiz_results_admin(lesson_id: int):
     lesson = Lesson.query.get_or_404(lesson_id)
     course = lesson.course
 
-    # このレッスンの全クイズ結果（新しい順）
+    # このレッスンの全クイズ結果（新しい順、ユーザー情報もまとめて読み込む）
     results = (
         QuizResult.query
+        .options(joinedload(QuizResult.user).joinedload(User.profile))
         .filter_by(lesson_id=lesson.id)
         .order_by(QuizResult.taken_at.desc())
         .all()
     )
 
-    # 受験回数などの集計（テンプレで使う用）
-    total_attempts = len(results)
-    avg_score = None
-    if total_attempts > 0:
-        avg_score = sum(r.score for r in results) / total_attempts
+    # 受験回数などの集計（テンプレで使う用、SQL で集計）
+    total_attempts, avg_score = (
+        db.session.query(func.count(QuizResult.id), func.avg(QuizResult.score))
+        .filter(QuizResult.lesson_id == lesson.id)
+        .one()
+    )
 
     return render_template(
         "courses/quiz_results_admin.html",
@@ -1275,9 +1432,13 @@ def quiz_lesson_stats(lesson_id: int):
     lesson = Lesson.query.get_or_404(lesson_id)
     course = lesson.course
 
-    # このレッスンの全問題（並び順順）
+    # このレッスンの全問題（並び順順、選択肢もまとめて読み込む、解説は表示しないので除外）
     questions = (
         QuizQuestion.query
+        .options(
+            selectinload(QuizQuestion.choices),
+            defer(QuizQuestion.explanation),
+        )
         .filter_by(lesson_id=lesson.id)
         .order_by(QuizQuestion.sort_order)
         .all()
@@ -1290,14 +1451,42 @@ def quiz_lesson_stats(lesson_id: int):
         .count()
     )
 
+    # 問題ごとの回答数・正解数（SQL で集計）
+    answer_counts = {
+        question_id: (total, correct)
+        for question_id, total, correct in (
+            db.session.query(
+                QuizResultDetail.question_id,
+                func.count(QuizResultDetail.id),
+                func.count(case((QuizResultDetail.is_correct, QuizResultDetail.id))),
+            )
+            .join(QuizResult, QuizResultDetail.result_id == QuizResult.id)
+            .filter(QuizResult.lesson_id == lesson.id)
+            .group_by(QuizResultDetail.question_id)
+            .all()
+        )
+    }
+
+    # (問題, 選択肢) ごとの選ばれた回数（SQL で集計）
+    choice_counts = {
+        (question_id, choice_id): count
+        for question_id, choice_id, count in (
+            db.session.query(
+                QuizResultDetail.question_id,
+                QuizResultDetail.choice_id,
+                func.count(QuizResultDetail.id),
+            )
+            .join(QuizResult, QuizResultDetail.result_id == QuizResult.id)
+            .filter(QuizResult.lesson_id == lesson.id)
+            .group_by(QuizResultDetail.question_id, QuizResultDetail.choice_id)
+            .all()
+        )
+    }
+
     stats_list = []
 
     for q in questions:
-        # この問題への全回答
-        details_q = QuizResultDetail.query.filter_by(question_id=q.id).all()
-
-        total_answers = len(details_q)
-        correct_answers = sum(1 for d in details_q if d.is_correct)
+        total_answers, correct_answers = answer_counts.get(q.id, (0, 0))
         correct_percent = (
             int(correct_answers * 100 / total_answers)
             if total_answers > 0 else None
@@ -1306,10 +1495,9 @@ def quiz_lesson_stats(lesson_id: int):
         # 選択肢ごとの選ばれた回数
         choice_items = []
         for ch in q.choices:
-            count = sum(1 for d in details_q if d.choice_id == ch.id)
             choice_items.append({
                 "choice": ch,
-                "count": count,
+                "count": choice_counts.get((q.id, ch.id), 0),
             })
 
         stats_list.append({
@@ -1344,11 +1532,15 @@ def quiz_result_detail(result_id: int):
     course = lesson.course
 
     # この結果に紐づく詳細（1問ごとの解答）
+    # 問題・選択肢は同じクエリで読み込む（innerjoin: 削除済みの問題/選択肢への解答は除外）
     details = (
         QuizResultDetail.query
+        .options(
+            joinedload(QuizResultDetail.question, innerjoin=True)
+            .selectinload(QuizQuestion.choices),
+            joinedload(QuizResultDetail.choice, innerjoin=True),
+        )
         .filter_by(result_id=result.id)
-        .join(QuizResultDetail.question)
-        .join(QuizResultDetail.choice)
         .all()
     )
 
@@ -1377,8 +1569,17 @@ def quiz_retry(result_id: int):
     if original.user_id != current_user.id:
         abort(404)
 
-    # 不正解の問題だけ抽出
-    wrong_details = [d for d in original.details if not d.is_correct]
+    # 不正解の問題だけ抽出（問題と選択肢もまとめて読み込む）
+    wrong_details = (
+        QuizResultDetail.query
+        .options(
+            joinedload(QuizResultDetail.question, innerjoin=True)
+            .selectinload(QuizQuestion.choices)
+        )
+        .filter_by(result_id=original.id, is_correct=False)
+        .order_by(QuizResultDetail.id)
+        .all()
+    )
 
     if not wrong_details:
         flash("不正解の問題はありません。全問正解です！", "info")
@@ -1405,16 +1606,15 @@ def quiz_take(lesson_id: int):
 
     # 受講してない人はNG（管理者はOK）
     if current_user.role != "admin":
-        enrollment = Enrollment.query.filter_by(
-            user_id=current_user.id, course_id=course.id
-        ).first()
-        if not enrollment:
+        if not _is_enrolled(current_user, course.id):
             flash("このコースを受講登録していません。", "danger")
             return redirect(url_for("main.course_detail", course_id=course.id))
 
-    # このレッスンの全問題
+    # このレッスンの全問題（受験中は解説を表示しないので読み込まない）
     questions = (
-        QuizQuestion.query.filter_by(lesson_id=lesson.id)
+        QuizQuestion.query
+        .options(defer(QuizQuestion.explanation))
+        .filter_by(lesson_id=lesson.id)
         .order_by(QuizQuestion.sort_order)
         .all()
     )
@@ -1435,19 +1635,10 @@ def quiz_take(lesson_id: int):
 
     # POST → 採点 & QuizResult / QuizResultDetail 保存
     correct_count = 0
+    now = datetime.utcnow()  # このリクエスト内の書き込みはすべて同じ時刻で記録
 
-    # ① QuizResult を先に作る（score は後で更新）
-    quiz_result = QuizResult(
-        user_id=current_user.id,
-        lesson_id=lesson.id,
-        score=0,
-        total_questions=len(questions),
-        taken_at=datetime.utcnow(),
-    )
-    db.session.add(quiz_result)
-    db.session.flush()  # quiz_result.id を取得する
-
-    # ② 各問題について、選ばれた選択肢を QuizResultDetail に保存
+    # ① 各問題について、選ばれた選択肢の id を集める
+    submitted: dict[int, int] = {}  # question_id -> choice_id
     for q in questions:
         field_name = f"q_{q.id}"  # フォーム側の name="q_{{ question.id }}" に対応
         selected_choice_id = request.form.get(field_name)
@@ -1457,34 +1648,69 @@ def quiz_take(lesson_id: int):
             continue
 
         try:
-            choice_id_int = int(selected_choice_id)
+            submitted[q.id] = int(selected_choice_id)
         except ValueError:
             continue
 
-        choice = QuizChoice.query.get(choice_id_int)
-        if not choice:
+    # 選ばれた選択肢は1クエリでまとめて取得
+    # （このレッスンの問題の選択肢に限定、採点では列しか使わないので遅延ロードは禁止）
+    choices_by_id: dict[int, QuizChoice] = {}
+    if submitted:
+        choices_by_id = {
+            c.id: c
+            for c in (
+                QuizChoice.query
+                .options(raiseload("*"))
+                .filter(
+                    QuizChoice.id.in_(submitted.values()),
+                    QuizChoice.question_id.in_(submitted.keys()),
+                )
+                .all()
+            )
+        }
+
+    # ② 採点（QuizResultDetail の行を先に組み立てておく）
+    detail_rows: list[dict] = []
+    for question_id, choice_id in submitted.items():
+        choice = choices_by_id.get(choice_id)
+        # 別の問題の選択肢 id が送られてきた場合は未回答扱い
+        if not choice or choice.question_id != question_id:
             continue
 
         is_correct = bool(choice.is_correct)
         if is_correct:
             correct_count += 1
 
-        detail = QuizResultDetail(
-            result_id=quiz_result.id,
-            question_id=q.id,
-            choice_id=choice.id,
-            is_correct=is_correct,
-        )
-        db.session.add(detail)
+        detail_rows.append({
+            "question_id": question_id,
+            "choice_id": choice.id,
+            "is_correct": is_correct,
+        })
 
-    # ③ スコア更新 & コミット
-    quiz_result.score = correct_count
+    # ③ 採点済みのスコアで QuizResult を INSERT し、RETURNING で id を受け取る
+    result_id = db.session.execute(
+        insert(QuizResult)
+        .values(
+            user_id=current_user.id,
+            lesson_id=lesson.id,
+            score=correct_count,
+            total_questions=len(questions),
+            taken_at=now,
+        )
+        .returning(QuizResult.id)
+    ).scalar_one()
+
+    # ④ QuizResultDetail をまとめて INSERT & コミット
+    if detail_rows:
+        for row in detail_rows:
+            row["result_id"] = result_id
+        db.session.execute(insert(QuizResultDetail), detail_rows)
     db.session.commit()
 
     flash(f"クイズ結果: {correct_count} / {len(questions)} 問正解でした。", "success")
 
-    # ④ クイズ結果の詳細ページへリダイレクト
-    return redirect(url_for("main.quiz_result_detail", result_id=quiz_result.id))
+    # ⑤ クイズ結果の詳細ページへリダイレクト
+    return redirect(url_for("main.quiz_result_detail", result_id=result_id))
 
 @bp.route("/quiz_retry/<int:result_id>", methods=["POST"])
 @login_required
@@ -1495,8 +1721,25 @@ def quiz_retry_submit(result_id: int):
     if original.user_id != current_user.id:
         abort(404)
 
-    # 不正解の問題だけ
-    wrong_details = [d for d in original.details if not d.is_correct]
+    # 不正解の問題だけ（問題と選択肢もまとめて読み込む）
+    wrong_details = (
+        QuizResultDetail.query
+        .options(
+            joinedload(QuizResultDetail.question, innerjoin=True)
+            .selectinload(QuizQuestion.choices)
+        )
+        .filter_by(result_id=original.id, is_correct=False)
+        .order_by(QuizResultDetail.id)
+        .all()
+    )
+
+    # 問題ごとの選択肢（id -> choice）と正解選択肢を先に作っておく
+    choices_map: dict[int, dict[int, QuizChoice]] = {}
+    correct_map: dict[int, QuizChoice | None] = {}
+    for d in wrong_details:
+        q = d.question
+        choices_map[q.id] = {c.id: c for c in q.choices}
+        correct_map[q.id] = next((c for c in q.choices if c.is_correct), None)
 
     total = len(wrong_details)
     score = 0
@@ -1510,7 +1753,8 @@ def quiz_retry_submit(result_id: int):
         selected = None
         is_correct = False
         if selected_id:
-            selected = QuizChoice.query.get(int(selected_id))
+            # この問題の選択肢以外の id が送られてきたら未回答扱い
+            selected = choices_map[q.id].get(int(selected_id))
             if selected:
                 is_correct = selected.is_correct
 
@@ -1518,7 +1762,7 @@ def quiz_retry_submit(result_id: int):
             score += 1
 
         # 正解選択肢
-        correct_choice = next((c for c in q.choices if c.is_correct), None)
+        correct_choice = correct_map[q.id]
 
         results.append(
             {
@@ -81,11 +81,13 @@ class Course(db.Model):
     level = db.Column(db.String(20), nullable=True)
 
     # 修正：backref → back_populates に変更！
+    # 一覧画面では使わないので遅延ロードのまま（アクセス時に sort_order 順で取得）
     lessons = db.relationship(
         "Lesson",
         back_populates="course",
         cascade="all, delete-orphan",
         lazy=True,
+        order_by="Lesson.sort_order",
     )
 
     # Enrollment と紐付いてるなら必要
@@ -93,15 +95,21 @@ class Course(db.Model):
 
 class Lesson(db.Model):
     __tablename__ = "lessons"
+    __table_args__ = (
+        # コース内のレッスン一覧（sort_order 順）用
+        db.Index("ix_lesson_course_sort", "course_id", "sort_order"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey("courses.id"), nullable=False)
     title = db.Column(db.String(100), nullable=False)
-    content = db.Column(db.Text, nullable=True)
+    # 本文はレッスン詳細でしか表示しないので、一覧等では読み込まない
+    content = db.deferred(db.Column(db.Text, nullable=True))
     sort_order = db.Column(db.Integer, default=1)
 
     # 修正：back_populates に統一
-    course = db.relationship("Course", back_populates="lessons")
+    # lesson.course はほぼ全画面で参照するので JOIN で同時に読み込む
+    course = db.relationship("Course", back_populates="lessons", lazy="joined")
 
     progress = db.relationship(
         "LessonProgress", back_populates="lesson", cascade="all, delete-orphan"
@@ -113,11 +121,32 @@ class Lesson(db.Model):
     quiz_results = db.relationship(
         "QuizResult", back_populates="lesson", cascade="all, delete-orphan"
     )
+    assets = db.relationship(
+        "LessonAsset", back_populates="lesson", cascade="all, delete-orphan"
+    )
+
+
+class LessonAsset(db.Model):
+    """レッスン用にアップロードされた画像（ファイル本体は static/uploads/lessons）"""
 
+    __tablename__ = "lesson_assets"
+
+    id = db.Column(db.Integer, primary_key=True)
+    lesson_id = db.Column(
+        db.Integer, db.ForeignKey("lessons.id"), nullable=False, index=True
+    )
+    filename = db.Column(db.String(255), nullable=False, unique=True)
+    uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    lesson = db.relationship("Lesson", back_populates="assets")
 
 
 class Enrollment(db.Model):
     __tablename__ = "enrollments"
+    __table_args__ = (
+        # 受講登録済みかの判定用（1ユーザー×1コースにつき1行）
+        db.Index("ix_enr_user_course", "user_id", "course_id", unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -130,6 +159,14 @@ class Enrollment(db.Model):
 
 class LessonProgress(db.Model):
     __tablename__ = "lesson_progress"
+    __table_args__ = (
+        # ダッシュボード等の「ユーザーの完了レッスン（期間指定）」用
+        db.Index(
+            "ix_lp_user_completed_at", "user_id", "is_completed", "completed_at"
+        ),
+        # 1ユーザー×1レッスンにつき1行（complete_lesson の UPSERT の衝突判定に使う）
+        db.Index("ix_lp_user_lesson", "user_id", "lesson_id", unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -147,6 +184,10 @@ class LessonProgress(db.Model):
 
 class QuizQuestion(db.Model):
     __tablename__ = "quiz_questions"
+    __table_args__ = (
+        # レッスン内の問題一覧（sort_order 順）用
+        db.Index("ix_qq_lesson_sort", "lesson_id", "sort_order"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     lesson_id = db.Column(db.Integer, db.ForeignKey("lessons.id"), nullable=False)
@@ -179,6 +220,12 @@ class QuizChoice(db.Model):
 
 class QuizResult(db.Model):
     __tablename__ = "quiz_results"
+    __table_args__ = (
+        # ユーザーごとの受験履歴（taken_at 順）用
+        db.Index("ix_qr_user_taken", "user_id", "taken_at"),
+        # レッスンごとの受験結果一覧（管理者用、taken_at 順）用
+        db.Index("ix_qr_lesson_taken", "lesson_id", "taken_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -207,6 +254,10 @@ class QuizResult(db.Model):
 # ★★★ 新規追加：クイズ結果の詳細（1問ごとの解答） ★★★
 class QuizResultDetail(db.Model):
     __tablename__ = "quiz_result_details"
+    __table_args__ = (
+        # 問題ごとの回答集計（正答率など）用
+        db.Index("ix_qrd_question", "question_id"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
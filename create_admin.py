@@ -1,11 +1,14 @@
 from werkzeug.security import generate_password_hash
 
-from app import create_app, db
+from app import create_app, db, init_db
 from app.models import User, UserProfile
 
 app = create_app()
 
 with app.app_context():
+    # テーブルがまだなければ作成
+    init_db()
+
     # すでに同じユーザーがいれば何もしない
     user = User.query.filter_by(username="admin").first()
     if user:
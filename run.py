@@ -1,10 +1,16 @@
 import os
-from app import create_app
+from app import create_app, init_db
 
 # Flaskアプリを生成
 app = create_app()
 
 if __name__ == "__main__":
+    # ローカル起動時はテーブル・インデックスを作成しておく
+    # （WSGI サーバー経由のデプロイでは `flask --app run init-db` を1回実行）
+    if not app.config["AUTO_INIT_DB"]:
+        with app.app_context():
+            init_db()
+
     # Render が渡してくる PORT を使う（なければローカル用に5000）
     port = int(os.environ.get("PORT", 5000))
     # 0.0.0.0 で待ち受けて外部からアクセス可能にする